@@ -1,7 +1,8 @@
+import os
+
 import click
 
 from .exceptions import DotfileException
-from .repository import Repositories
 
 
 def single(repos):
@@ -18,7 +19,7 @@ def single(repos):
 
 
 def confirm(method, files, repo):
-    """Return a list of files, or all files if none were specified.
+    """Return a list of files, or all dotfiles if none were specified.
 
     When no files are specified, all files are assumed.  But before we
     go ahead, confirm to make sure this is the intended operation.
@@ -29,18 +30,19 @@ def confirm(method, files, repo):
     # no files provided, so we assume all files after confirmation
     message = 'Are you sure you want to %s all dotfiles?' % method
     click.confirm(message, abort=True)
-    return str(repo).split()
+    return repo.contents()
 
 
 def show(repo, state):
     """TODO"""
-    for dotfile in repo.contents():
+    home = str(repo.home)
+    for dotfile in repo.classify():
         try:
             display = state[dotfile.state["code"]]
         except KeyError:
             continue
         char  = display['char']
-        name = dotfile.short_name(repo.home)
+        name = dotfile.short_name_str(home)
         fg = display.get('color', None)
         bg = display.get('bg', None)
         bold = display.get('bold', False)
@@ -51,20 +53,99 @@ def show(repo, state):
             click.secho("{0}".format(dotfile.state["msg"]), fg=fg)
 
 
+def unique(dotfiles):
+    """Drop dotfiles whose name or target is already in the batch.
+
+    The same file can be named twice, e.g. directly and through its
+    directory.  Running both operations concurrently would race on the
+    same paths.
+    """
+    seen = set()
+    result = []
+    for dotfile in dotfiles:
+        keys = {os.path.normpath(str(dotfile.name)),
+                os.path.normpath(str(dotfile.target))}
+        if not keys & seen:
+            seen.update(keys)
+            result.append(dotfile)
+    return result
+
+
 def perform(method, files, repo, copy, debug):
-    """Perform an operation on one or more dotfiles."""
-    for dotfile in repo.dotfiles(files):
+    """Perform an operation on the given file names or Dotfile objects.
+
+    Only file names are looked up in the repository, Dotfile objects
+    are used as they are.
+    """
+    names = [x for x in files if isinstance(x, (str, os.PathLike))]
+    dotfiles = [x for x in files if not isinstance(x, (str, os.PathLike))]
+    if names:
+        dotfiles.extend(repo.dotfiles(names))
+    perform_dotfiles(method, dotfiles, repo, copy, debug)
+
+
+def perform_dotfiles(method, dotfiles, repo, copy, debug):
+    """Perform an operation on one or more dotfiles.
+
+    The operations only touch their own dotfile, so they are run
+    concurrently in a thread pool.  Results are reported in the order
+    of the dotfiles, and a debug run stays sequential to keep the trace
+    of each dotfile together.  An unexpected error cancels the
+    operations not yet started and is raised once the finished ones
+    have been reported.
+    """
+    dotfiles = unique(dotfiles)
+    # parent directories are checked once per batch, not once per dotfile
+    known_dirs = set()
+    for dotfile in dotfiles:
+        dotfile.known_dirs = known_dirs
+
+    def apply(dotfile):
         try:
             getattr(dotfile, method)(copy, debug)
-            if not debug:
-                msg = '%s%s' % (method, 'd' if method[-1] == 'e' else 'ed')
-                click.secho('%s %s' % (msg, dotfile.short_name(repo.home)),
-                            fg='green')
         except DotfileException as err:
-            click.secho(str(err), fg='red', bg='white')
-
-
-pass_repos = click.make_pass_decorator(Repositories)
+            return err
+
+    home = str(repo.home)
+    verb = '%s%s' % (method, 'd' if method[-1] == 'e' else 'ed')
+
+    def messages(results):
+        for dotfile, err in results:
+            if err is not None:
+                yield click.style(str(err), fg='red', bg='white')
+            elif not debug:
+                name = dotfile.short_name_str(home)
+                yield click.style('%s %s' % (verb, name), fg='green')
+
+    if debug:
+        # interleave with the trace printed by the operations
+        for line in messages(zip(dotfiles, map(apply, dotfiles))):
+            click.echo(line)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    from .repository import WORKERS
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = [pool.submit(apply, x) for x in dotfiles]
+        for future in futures:
+            if future.exception() is not None:
+                for pending in futures:
+                    pending.cancel()
+                break
+
+    # every future is either cancelled or finished by now
+    done = [(d, f) for d, f in zip(dotfiles, futures) if not f.cancelled()]
+    errors = [f.exception() for d, f in done if f.exception() is not None]
+    buf = ['%s\n' % x for x in messages((d, f.result()) for d, f in done
+                                        if f.exception() is None)]
+    if buf:
+        click.echo(''.join(buf), nl=False)
+    if errors:
+        raise errors[0]
+
+
+# ctx.obj is always the Repositories instance created by cli() below
+pass_repos = click.pass_obj
 CONTEXT_SETTINGS = dict(auto_envvar_prefix='DOTFILES',
                         help_option_names=['-h', '--help'])
 
@@ -73,21 +154,24 @@ CONTEXT_SETTINGS = dict(auto_envvar_prefix='DOTFILES',
 @click.option('--repos', '-r', type=click.Path(), multiple=True,
               help='Repository locations.', default=['~/Dotfiles'],
               show_default=True)
+@click.option('--index', type=click.Path(dir_okay=False),
+              help='Cache the repository contents in this file, '
+              'e.g. ~/.cache/dotfiles/index.json.')
 @click.version_option(None, '-v', '--version')
 @click.pass_context
-def cli(ctx, repos):
+def cli(ctx, repos, index):
     """Dotfiles is a tool to make managing your dotfile symlinks in $HOME easy,
     allowing you to keep all your dotfiles in a single directory.
     """
 
     # temporary notice for folks tracking git
-    import os
     if os.environ.get('DOTFILES_REPO'):
         click.echo("Error: repository variable has changed to \"DOTFILES_REPOS\", please update")
         exit(-1)
 
+    from .repository import Repositories
     try:
-        ctx.obj = Repositories(repos)
+        ctx.obj = Repositories(repos, index=index)
     except FileNotFoundError as e:
         raise click.ClickException('Directory not found: %s' % e)
 
@@ -188,16 +272,16 @@ def sync(repos, copy, debug, forced):
     # Check the missing and conflicting files
     missing_dotfiles = []
     conflict_dotfiles = []
-    for dotfile in repo.contents():
+    for dotfile in repo.classify():
         state = dotfile.state["code"]
         if state == "missing":
-            missing_dotfiles.append(dotfile.name)
+            missing_dotfiles.append(dotfile)
         elif state == "conflict":
-            conflict_dotfiles.append(dotfile.name)
+            conflict_dotfiles.append(dotfile)
 
     # Missing files
     if not forced:
-        perform("sync", missing_dotfiles, repo, copy, debug)
+        perform_dotfiles("sync", missing_dotfiles, repo, copy, debug)
         if len(conflict_dotfiles) > 0:
             click.echo("Conflicting files not synced. Overwrite them with --forced option")
         if not debug:
@@ -205,8 +289,8 @@ def sync(repos, copy, debug, forced):
 
     else:
     # Conflicting only when forced
-        perform("sync", missing_dotfiles + conflict_dotfiles,
-                repo, copy, debug)
+        perform_dotfiles("sync", missing_dotfiles + conflict_dotfiles,
+                         repo, copy, debug)
         if not debug:
             click.echo(("\nSyncronized {0:d} missing "
                        "and {1:d} conflicting files.").format(len(missing_dotfiles),
@@ -1,35 +1,106 @@
+import errno
 import os
+import stat
+
+from functools import lru_cache, wraps
 
 from click import echo, secho
-from hashlib import md5
 from pathlib import Path
-from shutil import copyfile, SameFileError
 
 from .exceptions import \
     IsSymlink, NotASymlink, Exists, NotFound, Dangling, \
     TargetExists, TargetMissing, InRepository
 
 UNUSED = False
+BUFSIZE = 64 * 1024
+
+
+def _probe(path, follow_symlinks=False):
+    """Return the stat result for path, or None if it does not exist."""
+    try:
+        return os.stat(path, follow_symlinks=follow_symlinks)
+    except FileNotFoundError:
+        return None
 
 
-def _move_echo(source, target):
-    secho('MOVE  {0} -> {1}'.format(source, target), fg='yellow')
+@lru_cache(maxsize=256)
+def _reldir(dir, start):
+    return os.path.relpath(dir, start)
 
 
-def _copy_echo(source, target):
-    secho('COPY  {0} -> {1}'.format(source, target), fg='cyan')
+def _relpath(target, start):
+    """Return target relative to start, both absolute path strings.
+
+    Only the directory part is computed (and cached), dotfiles sharing
+    a directory reuse it.
+    """
+    dir, name = os.path.split(target)
+    reldir = _reldir(dir, start)
+    return name if reldir == os.curdir else os.path.join(reldir, name)
+
+
+def _copyfile(source, target):
+    """Copy the contents of source to target, like shutil.copyfile.
+
+    Where available, os.copy_file_range lets the kernel copy the data,
+    which is a reflink on copy-on-write filesystems.  Otherwise, or if
+    the filesystem refuses, the data is copied through userspace.
+    """
+    from shutil import copyfile, copyfileobj, SameFileError
+
+    if not hasattr(os, 'copy_file_range'):
+        return copyfile(source, target)
+    with open(source, 'rb') as fsrc:
+        if _same_inode(os.fstat(fsrc.fileno()), _probe(target, True)):
+            raise SameFileError('{0!r} and {1!r} are the same file'.
+                                format(str(source), str(target)))
+        with open(target, 'wb') as fdst:
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                         1 << 30):
+                    pass
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                     errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                copyfileobj(fsrc, fdst)
+
 
+def _mutator(method):
+    """Drop the cached stats before and after a mutating operation."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._invalidate()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._invalidate()
+    return wrapper
 
-def _link_echo(source, target):
-    secho('LINK  {0} -> {1}'.format(source, target), fg='green')
 
+def _islink(st):
+    return st is not None and stat.S_ISLNK(st.st_mode)
 
-def _mkdir_echo(source):
-    secho('MKDIR  {0}'.format(source), fg='black')
 
+def _same_inode(a, b):
+    return (a is not None and b is not None and
+            (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino))
 
-def _unlink_echo(source):
-    secho('UNLINK  {0}'.format(source), fg='magenta')
+
+_COLORS = {'MOVE': 'yellow', 'COPY': 'cyan', 'LINK': 'green',
+           'MKDIR': 'black', 'UNLINK': 'magenta'}
+
+
+def _echo(op, source, target=None):
+    """Show a step of an operation, as done in debug mode."""
+    if target is None:
+        msg = '%s  %s' % (op, source)
+    else:
+        msg = '%s  %s -> %s' % (op, source, target)
+    secho(msg, fg=_COLORS[op])
 
 
 class Dotfile(object):
@@ -39,12 +110,30 @@ class Dotfile(object):
     :param target: where the symlink should point to (~/Dotfiles/vimrc)
     """
     RELATIVE_SYMLINKS = False
+    # directories known to exist, shared by the dotfiles of one batch
+    known_dirs = None
 
     def __init__(self, name, target):
         # if not name.is_file() and not name.is_symlink():
         #     raise NotFound(name)
         self.name = Path(name)
         self.target = Path(target)
+        self._stat_cache = {}
+        self._entry = None
+        self._state = None
+        self._dirs_ensured = False
+
+    @classmethod
+    def from_direntry(cls, name, entry):
+        """Construct a dotfile from the os.scandir() entry of its target.
+
+        The entry is kept until the target is first stat'ed, so the
+        result the directory scan may already hold is reused instead of
+        stat'ing the target again.
+        """
+        dotfile = cls(name, entry.path)
+        dotfile._entry = entry
+        return dotfile
 
     def __str__(self):
         return str(self.name)
@@ -52,21 +141,62 @@ class Dotfile(object):
     def __repr__(self):
         return '<Dotfile %r>' % self.name
 
+    def _stat(self, path, follow_symlinks=False):
+        """Return the (cached) stat result for path, or None if missing.
+
+        Each path is stat'ed at most once until the cache is invalidated
+        by one of the mutating operations. The target's lstat comes from
+        its os.scandir() entry when the dotfile was built from one.
+        """
+        key = (str(path), follow_symlinks)
+        try:
+            return self._stat_cache[key]
+        except KeyError:
+            pass
+        entry = self._entry
+        if (entry is not None and key[0] == str(self.target) and
+                not (follow_symlinks and entry.is_symlink())):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                st = None
+        else:
+            st = _probe(key[0], follow_symlinks)
+        self._stat_cache[key] = st
+        return st
+
+    def _invalidate(self):
+        """Forget all cached stats, the state and ensured directories."""
+        self._stat_cache.clear()
+        self._state = None
+        self._entry = None
+        self._dirs_ensured = False
+
     def _ensure_dirs(self, debug):
         """Ensure the directories for both name and target are in place.
 
         This is needed for the 'add' and 'link' operations where the
         directory structure is expected to exist.
         """
+        if self._dirs_ensured:
+            return
+        known = self.known_dirs
+
         def ensure(dir, debug):
+            if known is not None and dir in known:
+                return
             if not dir.is_dir():
                 if debug:
-                    _mkdir_echo(dir)
-                else:
-                    dir.mkdir(parents=True)
+                    _echo('MKDIR', dir)
+                    return
+                dir.mkdir(parents=True, exist_ok=True)
+            if known is not None:
+                known.add(dir)
 
         ensure(self.name.parent, debug)
         ensure(self.target.parent, debug)
+        # add and sync call this again through _link
+        self._dirs_ensured = not debug
 
     def _prune_dirs(self, debug):
         # TODO
@@ -82,7 +212,8 @@ class Dotfile(object):
         source = self.name
         target = self.target
 
-        if self.name.is_symlink():
+        # not cached: callers may have just moved or unlinked the name
+        if _islink(_probe(source)):
             # source = self.target
             # target = self.name.resolve()
             source_true_identity = self.name.resolve()
@@ -90,23 +221,23 @@ class Dotfile(object):
             # Copy only when the true identify exists
             if source_true_identity.exists():
                 if debug:
-                    _copy_echo(source_true_identity, target)
+                    _echo('COPY', source_true_identity, target)
                 else:
-                    copyfile(source_true_identity, target)
+                    _copyfile(source_true_identity, target)
 
             if debug:
-                _unlink_echo(source)
+                _echo('UNLINK', source)
             else:
-                source.unlink()
+                os.unlink(os.fspath(source))
 
         elif self.RELATIVE_SYMLINKS:
-            target = os.path.relpath(target, source.parent)
+            target = _relpath(str(target), str(source.parent))
 
         if debug:
-            _link_echo(source, target)
+            _echo('LINK', source, target)
         else:
             self._ensure_dirs(debug)
-            source.symlink_to(target)
+            os.symlink(os.fspath(target), os.fspath(source))
 
     def _copy(self, debug):
         """Copy the file from name to target without error checking.
@@ -115,60 +246,97 @@ class Dotfile(object):
         source = self.name
         target = self.target
 
-        if self.name.is_symlink():
+        if _islink(self._stat(self.name)):
             raise IsSymlink(self.name.as_posix())
-        
 
         if debug:
-            _copy_echo(source, target)
+            _echo('COPY', source, target)
         else:
             self._ensure_dirs(debug)
-            try:
-                copyfile(source.as_posix(), target.as_posix())
-            except SameFileError:
-                raise
+            _copyfile(source, target)
 
     def _unlink(self, debug):
         """Remove a symlink in the home directory, no error checking."""
         if debug:
-            _unlink_echo(self.name)
+            _echo('UNLINK', self.name)
         else:
-            self.name.unlink()
+            os.unlink(os.fspath(self.name))
 
     def short_name(self, home):
         """A shorter, more readable name given a home directory."""
         return self.name.relative_to(home)
 
+    def short_name_str(self, home):
+        """Like short_name, but home and the result are plain strings."""
+        name = str(self.name)
+        prefix = os.path.join(home, '')
+        if name.startswith(prefix):
+            return name[len(prefix):]
+        return os.path.relpath(name, home)
+
     def _is_present(self):
         """Is this dotfile present in the repository?"""
-        return self.name.is_symlink() and (self.name.resolve() == self.target)
+        return (_islink(self._stat(self.name)) and
+                self.name.resolve() == self.target)
 
     def _same_contents(self):
-        return (md5(self.name.read_bytes()).hexdigest() ==
-                md5(self.target.read_bytes()).hexdigest())
+        """Compare both files, reading them in chunks.
+
+        Hardlinks to the same inode and files of different size are
+        decided from the cached stats without reading either file.
+        """
+        name_st = self._stat(self.name, follow_symlinks=True)
+        target_st = self._stat(self.target, follow_symlinks=True)
+        if _same_inode(name_st, target_st):
+            return True
+        if name_st is not None and target_st is not None:
+            if name_st.st_size != target_st.st_size:
+                return False
+        with self.name.open('rb') as a, self.target.open('rb') as b:
+            while True:
+                chunk = a.read(BUFSIZE)
+                if chunk != b.read(BUFSIZE):
+                    return False
+                if not chunk:
+                    return True
 
     def _source_is_newer(self):
         def _ctime(p):
-            return p.stat().st_ctime
+            return self._stat(p, follow_symlinks=True).st_ctime
         return _ctime(self.name) > _ctime(self.target)
 
     @property
     def state(self):
-        """The current state of this dotfile."""
-        if self.target.is_symlink():
-            return dict(code='external')
+        """The current state of this dotfile.
 
-        if not self.name.exists():
-            # no $HOME file or symlink
-            return dict(code='missing')
+        Like the stats it is based on, it is only computed once until
+        the next mutating operation.
+        """
+        if self._state is None:
+            self._state = self._compute_state()
+        return self._state
 
-        if self.name.is_symlink():
+    def _compute_state(self):
+        target_st = self._stat(self.target)
+        if _islink(target_st):
+            return dict(code='external')
+
+        name_st = self._stat(self.name)
+        if _islink(name_st):
+            # resolve the link, a dangling one counts as missing
+            name_st = self._stat(self.name, follow_symlinks=True)
+            if name_st is None:
+                return dict(code='missing')
             # name exists, is a link, but isn't a link to the target
-            if not self.name.samefile(self.target):
+            if not _same_inode(name_st, target_st):
                 return dict(code='conflict',
                             msg="Source and target links are not same file!")
             return dict(code='link')
 
+        if name_st is None:
+            # no $HOME file or symlink
+            return dict(code='missing')
+
         if not self._same_contents():
             # name exists, is a file, but differs from the target
             # TODO: return the status of newer files
@@ -185,6 +353,7 @@ class Dotfile(object):
 
         return dict(code='copy')
 
+    @_mutator
     def add(self, copy=False, debug=False, home=Path.home()):
         """Move a dotfile to its target and create a link.
 
@@ -195,66 +364,79 @@ class Dotfile(object):
         else:                   # Symlink to target
             if self._is_present():
                 raise InRepository(self.short_name(home))
-            if self.target.exists():
+            if self._stat(self.target, follow_symlinks=True) is not None:
                 raise TargetExists(self.name)
             self._ensure_dirs(debug)
-            if not self.name.is_symlink():
+            if not _islink(self._stat(self.name)):
                 if debug:
-                    _move_echo(self.name, self.target)
+                    _echo('MOVE', self.name, self.target)
                 else:
-                    self.name.replace(self.target)
+                    os.replace(os.fspath(self.name), os.fspath(self.target))
             self._link(debug, home)
 
+    @_mutator
     def remove(self, copy=UNUSED, debug=False):
         """Remove a dotfile and move target to its original location."""
-        if not self.name.is_symlink():
+        if not _islink(self._stat(self.name)):
             raise NotASymlink(self.name)
-        if not self.target.is_file():
+        target_st = self._stat(self.target, follow_symlinks=True)
+        if target_st is None or not stat.S_ISREG(target_st.st_mode):
             raise TargetMissing(self.name)
         self._unlink(debug)
         if debug:
-            _move_echo(self.target, self.name)
+            _echo('MOVE', self.target, self.name)
         else:
-            self.target.replace(self.name)
+            os.replace(os.fspath(self.target), os.fspath(self.name))
 
     def sync(self, copy=False, debug=False, home=Path.home()):
         """ Syncronize missing or conflicting files, no checking
         forced option determined inside cli.sync() method
+
+        Unlike the other operations, the cached state is used, which
+        cli.sync() has just computed to select the dotfile.  The cache
+        is dropped afterwards.
         """
         state = self.state["code"]
         if state not in ("missing", "conflict"):
             raise ValueError(("Something's wrong with the cli.sync method. "
                               "Should only work on missing and conflicting files"))
-        # If conflicting files, remove the ones in home folder
-        """TODO backup"""
-        # print(self.name, self.state)
-        if copy is False:       # only symlink method
-            if state == "conflict":
-                self._unlink(debug)
-            self._ensure_dirs(debug)
-            self._link(debug, home)
-        else:
-            self._copy()
+        try:
+            # If conflicting files, remove the ones in home folder
+            """TODO backup"""
+            # print(self.name, self.state)
+            if copy is False:       # only symlink method
+                if state == "conflict":
+                    self._unlink(debug)
+                self._ensure_dirs(debug)
+                self._link(debug, home)
+            else:
+                self._copy()
+        finally:
+            self._invalidate()
 
+    @_mutator
     def enable(self, copy=False, debug=False, home=Path.home()):
         """Create a symlink or copy from name to target."""
         if copy:
             raise NotImplementedError()
-        if self.name.exists():
+        if self._stat(self.name, follow_symlinks=True) is not None:
             raise Exists(self.name)
-        if not self.target.exists():
+        if self._stat(self.target, follow_symlinks=True) is None:
             raise TargetMissing(self.name)
         self._ensure_dirs(debug)
         self._link(debug, home)
 
+    @_mutator
     def disable(self, copy=UNUSED, debug=False):
         """Remove a dotfile from name to target."""
-        if not self.name.is_symlink():
+        if not _islink(self._stat(self.name)):
             raise NotASymlink(self.name)
-        if self.name.exists():
-            if not self.target.exists():
+        name_st = self._stat(self.name, follow_symlinks=True)
+        if name_st is not None:
+            target_st = self._stat(self.target, follow_symlinks=True)
+            if target_st is None:
                 raise TargetMissing(self.name)
-            if not self.name.samefile(self.target):
+            if not _same_inode(name_st, target_st):
                 raise RuntimeError
         self._unlink(debug)
         self._prune_dirs(debug)
@@ -1,4 +1,6 @@
+import json
 import os
+import time
 
 from click import echo, secho
 from pathlib import Path
@@ -9,13 +11,20 @@ from .dotman import Dotfile
 from .exceptions import DotfileException, TargetIgnored
 from .exceptions import NotRootedInHome, InRepository, IsDirectory
 
+# threads for the I/O bound work done on many dotfiles at once
+WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# directories modified less than this long (in ns) before the index was
+# written may have changed again within the same timestamp
+RACY_NS = 2 * 10 ** 9
+
 
 class Repositories(object):
     """An iterable collection of repository objects."""
-    def __init__(self, paths, home=Path.home()):
+    def __init__(self, paths, home=Path.home(), index=None):
         self.repos = []
         for path in paths:
-            self.repos.append(Repository(path, home))
+            self.repos.append(Repository(path, home, index))
 
     def __len__(self):
         return len(self.repos)
@@ -34,9 +43,11 @@ class Repository(object):
                        '*~',
                        "*#", ".DS_Store", "LICENSE"]
 
-    def __init__(self, path, home=Path.home()):
+    def __init__(self, path, home=Path.home(), index=None):
         self.path = Path(path).expanduser().resolve()
         self.home = Path(home).expanduser().resolve()
+        # file caching the repository contents between runs, if any
+        self.index = Path(index).expanduser() if index else None
 
         if not self.path.exists():
             secho('Creating new repository: %s' % self.path,
@@ -97,20 +108,112 @@ class Repository(object):
 
         return Dotfile(path, target)
 
+    def _scan(self, dir, mtimes=None):
+        """Yield directory entries for all unignored files below a directory.
+
+        Symlinked and ignored directories (.git) are neither listed nor
+        descended into.  If a mtimes dict is given, it is filled with the
+        modification time of every directory scanned.
+        """
+        if mtimes is not None:
+            mtimes[str(dir)] = os.stat(str(dir)).st_mtime_ns
+        with os.scandir(str(dir)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not (entry.is_symlink() or self._ignore(entry.path)):
+                        yield from self._scan(entry.path, mtimes)
+                elif not self._ignore(entry.path):
+                    yield entry
+
+    def _load_index(self):
+        """Return the repository files recorded in the index, if still valid.
+
+        Adding, removing or renaming a file changes the modification time
+        of its directory, so the recorded list is valid as long as none
+        of the recorded directories changed.  A directory modified shortly
+        before the scan may change again without a different time, so it
+        is only trusted once its time is clearly older than the scan.
+        """
+        try:
+            with self.index.open() as f:
+                index = json.load(f)[str(self.path)]
+            if index['ignore'] != self.IGNORE_PATTERNS:
+                return None
+            racy = index['time'] - RACY_NS
+            for dir, mtime in index['dirs'].items():
+                if mtime >= racy or os.stat(dir).st_mtime_ns != mtime:
+                    return None
+            return index['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save_index(self, files, mtimes, started):
+        """Record the repository files and directory times in the index.
+
+        started is when the scan began, in ns.  Entries of repositories
+        that no longer exist are dropped.
+        """
+        try:
+            try:
+                with self.index.open() as f:
+                    index = json.load(f)
+                index = {k: v for k, v in index.items() if os.path.isdir(k)}
+            except (OSError, ValueError, AttributeError):
+                index = {}
+            index[str(self.path)] = dict(ignore=self.IGNORE_PATTERNS,
+                                         time=started, dirs=mtimes,
+                                         files=files)
+            self.index.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index.with_name('%s.%d' % (self.index.name,
+                                                  os.getpid()))
+            with tmp.open('w') as f:
+                json.dump(index, f)
+            os.replace(str(tmp), str(self.index))
+        except OSError:
+            pass
+
     def _contents(self, dir):
         """Return all unignored files contained below a directory."""
-        def skip(path):
-            return path.is_dir() or self._ignore(path)
-
-        return [x for x in dir.rglob('*') if not skip(x)]
+        return [Path(x.path) for x in self._scan(dir)]
 
     def contents(self):
-        """Return dotfile objects for each file in the repository."""
-        def construct(target):
-            return Dotfile(self._dotfile_path(target), target)
+        """Return dotfile objects for each file in the repository.
+
+        The file list is served from the index when no directory in the
+        repository changed since it was written.
+        """
+        files = self._load_index() if self.index else None
+        if files is not None:
+            def construct(target):
+                target = Path(target)
+                return Dotfile(self._dotfile_path(target), target)
+        else:
+            def construct(entry):
+                target = Path(entry.path)
+                return Dotfile.from_direntry(self._dotfile_path(target), entry)
+
+            mtimes = {}
+            started = int(time.time() * 10 ** 9)
+            files = list(self._scan(self.path, mtimes))
+            if self.index:
+                self._save_index([x.path for x in files], mtimes, started)
+
+        return sorted(map(construct, files), key=attrgetter('name'))
+
+    def classify(self):
+        """Return the repository contents with their states computed.
+
+        Comparing a copied dotfile with its target reads both files, so
+        the states are computed concurrently in a thread pool; file reads
+        release the GIL.  Each dotfile caches its state.
+        """
+        from concurrent.futures import ThreadPoolExecutor
 
-        contents = self._contents(self.path)
-        return sorted(map(construct, contents), key=attrgetter('name'))
+        contents = self.contents()
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            for _ in pool.map(attrgetter('state'), contents):
+                pass
+        return contents
 
     def dotfiles(self, paths):
         """Return a collection of dotfiles given a list of paths.
@@ -1,14 +1,21 @@
 import pytest
+
+from pathlib import Path
 from click.testing import CliRunner
 
-from dotfiles.repository import Repository
+from dotman.repository import Repository
+
+
+@pytest.fixture(scope='function')
+def index(tmpdir):
+    return Path(str(tmpdir), 'cache', 'index.json')
 
 
 @pytest.fixture(scope='function', params=['', 'home'])
-def repo(request, tmpdir):
+def repo(request, tmpdir, index):
     path = str(tmpdir.ensure_dir('repo'))
     home = str(tmpdir.ensure_dir(request.param))
-    return Repository(path, home)
+    return Repository(path, home, index)
 
 
 @pytest.fixture(scope='function')
@@ -1,4 +1,11 @@
-from dotfiles.cli import cli
+import os
+import subprocess
+import sys
+import pytest
+
+from pathutils import is_file, is_link, mkdir, touch
+from dotman.cli import cli, perform, sync
+from dotman.dotman import Dotfile
 
 
 class TestCli(object):
@@ -8,3 +15,105 @@ class TestCli(object):
         result = runner.invoke(cli, ['-r', str(repo.path), 'status'])
         assert not result.exception
         assert result.output == ''
+
+
+def test_perform_duplicates(repo, capsys):
+    rc = repo.home / '.cfg/rc'
+    touch(rc)
+    rc.write_text('content')
+
+    perform('add', [str(rc.parent), str(rc)], repo, False, False)
+    out = capsys.readouterr().out
+    assert out.count('added .cfg/rc') == 1
+    assert is_link(rc)
+    assert is_file(repo.path / '.cfg/rc')
+    assert rc.read_text() == 'content'
+
+
+def test_perform_unexpected_error(repo, capsys):
+    names = ['.a', '.b', '.zmissing', '.c', '.d']
+    for name in names:
+        if name != '.zmissing':
+            touch(repo.home / name)
+
+    with pytest.raises(FileNotFoundError):
+        perform('add', [str(repo.home / x) for x in names],
+                repo, False, False)
+    out = capsys.readouterr().out
+    assert 'added .a' in out
+    assert 'added .b' in out
+    # whatever ran after the failure is still reported
+    for name in ['.c', '.d']:
+        assert is_link(repo.home / name) == ('added %s' % name in out)
+
+
+def test_sync_reuses_state(repo, runner, monkeypatch):
+    names = ['.a', '.b', '.c', '.d', '.e']
+    for name in names:
+        (repo.path / name).write_text('repository')
+        (repo.home / name).write_text('home')
+
+    calls = []
+    same_contents = Dotfile._same_contents
+
+    def counting(self):
+        calls.append(self.name)
+        return same_contents(self)
+    monkeypatch.setattr(Dotfile, '_same_contents', counting)
+
+    result = runner.invoke(sync, ['-f'], obj=[repo])
+    assert not result.exception
+    assert 'Syncronized 0 missing and 5 conflicting files' in result.output
+    assert len(calls) == len(names)
+    for name in names:
+        assert is_link(repo.home / name)
+
+
+def test_perform_dotfiles(repo, capsys):
+    for name in ['with space', 'other']:
+        touch(repo.path / name)
+    dotfiles = repo.contents()
+
+    perform('enable', dotfiles, repo, False, False)
+    out = capsys.readouterr().out
+    assert out.count('enabled') == 2
+    for dotfile in dotfiles:
+        assert is_link(dotfile.name)
+
+
+def test_perform_creates_dirs_lazily(repo, capsys):
+    # copying a symlink is refused before any directory is created
+    touch(repo.home / '.z/rc')
+    for name in ['.x/link', '.y/link']:
+        link = repo.home / name
+        mkdir(link.parent)
+        link.symlink_to(repo.home / '.z/rc')
+    (repo.path / '.x').write_text('')
+
+    names = ['.x/link', '.y/link', '.z/rc']
+    perform('add', [str(repo.home / x) for x in names], repo, True, False)
+    out = capsys.readouterr().out
+    assert out.count('is a symlink') == 2
+    assert 'added .z/rc' in out
+    assert not (repo.path / '.y').exists()
+    assert is_file(repo.path / '.z/rc')
+
+
+def test_index_option(runner, repo, index):
+    result = runner.invoke(cli, ['-r', str(repo.path), 'status'])
+    assert not result.exception
+    assert not index.exists()
+
+    result = runner.invoke(cli, ['-r', str(repo.path), '--index', str(index),
+                                 'status'])
+    assert not result.exception
+    assert index.exists()
+
+
+def test_lazy_imports():
+    code = ('import sys, dotman.cli; '
+            'print(sorted(m for m in sys.modules '
+            'if m in ("dotman.dotman", "dotman.repository", "shutil")))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.strip() == b'[]'
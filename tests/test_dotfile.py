@@ -1,55 +1,174 @@
+import errno
+import os
 import pytest
 
 from pathlib import Path
-from dotfiles.dotfile import Dotfile
-from dotfiles.pathutils import is_file, is_link, touch, mkdir
-from dotfiles.exceptions import TargetExists, IsSymlink, \
+from shutil import SameFileError
+import dotman.dotman
+from dotman.dotman import Dotfile, BUFSIZE, _copyfile, _probe
+from pathutils import is_file, is_link, touch, mkdir
+from dotman.exceptions import TargetExists, InRepository, \
     TargetMissing, NotASymlink, Exists
 
 
 def _make_dotfile(repo, name, target=None):
-    return Dotfile(repo.homedir.joinpath(name),
+    return Dotfile(repo.home.joinpath(name),
                    repo.path.joinpath(target if target else name))
 
 
+def _state(dotfile):
+    # the state is cached per instance, look at it through a fresh one
+    return Dotfile(dotfile.name, dotfile.target).state['code']
+
+
 @pytest.mark.parametrize('name', ['.a'])
 def test_str(repo, name):
     dotfile = _make_dotfile(repo, name, '.b')
-    assert dotfile.name == repo.homedir / name
+    assert dotfile.name == repo.home / name
 
 
 @pytest.mark.parametrize('name', ['.foo'])
 def test_short_name(repo, name):
     dotfile = _make_dotfile(repo, name)
-    assert dotfile.name == repo.homedir / name
-    assert dotfile.short_name(repo.homedir) == Path(name)
+    assert dotfile.name == repo.home / name
+    assert dotfile.short_name(repo.home) == Path(name)
+    assert dotfile.short_name_str(str(repo.home)) == name
 
 
 def test_is_present(repo):
     dotfile = _make_dotfile(repo, '.foo')
-    assert not dotfile.is_present()
+    assert not dotfile._is_present()
     # TODO: more
 
 
 def test_state(repo):
     dotfile = _make_dotfile(repo, '.vimrc', 'vimrc')
-    assert dotfile.state == 'error'
+    assert _state(dotfile) == 'missing'
 
     dotfile.target.touch()
     dotfile.name.symlink_to(dotfile.target)
-    assert dotfile.state == 'ok'
+    assert _state(dotfile) == 'link'
 
     dotfile.name.unlink()
-    assert dotfile.state == 'missing'
+    assert _state(dotfile) == 'missing'
 
     dotfile.name.touch()
-    assert dotfile.state == 'ok'
+    assert _state(dotfile) == 'copy'
 
     dotfile.name.write_text('test content')
-    assert dotfile.state == 'conflict'
+    assert _state(dotfile) == 'conflict'
 
     dotfile.target.write_text('test content')
-    assert dotfile.state == 'ok'
+    assert _state(dotfile) == 'copy'
+
+
+@pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
+def test_state_after_operations(repo, path):
+    dotfile = _make_dotfile(repo, path)
+    touch(dotfile.target)
+    assert dotfile.state['code'] == 'missing'
+
+    dotfile.enable()
+    assert dotfile.state['code'] == 'link'
+
+    dotfile.disable()
+    assert dotfile.state['code'] == 'missing'
+
+    dotfile.sync()
+    assert dotfile.state['code'] == 'link'
+
+    dotfile.name.unlink()
+    dotfile.name.write_text('conflict')
+    dotfile._invalidate()
+    assert dotfile.state['code'] == 'conflict'
+
+    dotfile.sync()
+    assert dotfile.state['code'] == 'link'
+
+    dotfile.remove()
+    assert is_file(dotfile.name)
+    dotfile.add()
+    assert dotfile.state['code'] == 'link'
+
+
+def test_same_contents_hardlink(repo, monkeypatch):
+    dotfile = _make_dotfile(repo, '.foo')
+    dotfile.target.write_text('content')
+    os.link(str(dotfile.target), str(dotfile.name))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('file was opened')
+    monkeypatch.setattr(Path, 'open', fail)
+    assert dotfile._same_contents()
+    assert dotfile.state['code'] == 'copy'
+
+
+def test_same_contents_size(repo, monkeypatch):
+    dotfile = _make_dotfile(repo, '.foo')
+    dotfile.target.write_text('a')
+    dotfile.name.write_text('bb')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('file was opened')
+    monkeypatch.setattr(Path, 'open', fail)
+    assert not dotfile._same_contents()
+
+
+@pytest.mark.parametrize('offset', [0, BUFSIZE - 1, BUFSIZE, 2 * BUFSIZE])
+def test_same_contents_chunks(repo, offset):
+    data = bytes(3 * BUFSIZE)
+    dotfile = _make_dotfile(repo, '.foo')
+    dotfile.target.write_bytes(data)
+    dotfile.name.write_bytes(data)
+    assert Dotfile(dotfile.name, dotfile.target)._same_contents()
+
+    dotfile.name.write_bytes(data[:offset] + b'x' + data[offset + 1:])
+    assert not Dotfile(dotfile.name, dotfile.target)._same_contents()
+
+
+def test_from_direntry(repo, monkeypatch):
+    dotfile = _make_dotfile(repo, '.foo')
+    touch(dotfile.target)
+    entry, = (e for e in os.scandir(str(repo.path)) if e.name == '.foo')
+
+    probed = []
+
+    def probe(path, follow_symlinks=False):
+        probed.append(path)
+        return _probe(path, follow_symlinks)
+    monkeypatch.setattr(dotman.dotman, '_probe', probe)
+
+    dotfile = Dotfile.from_direntry(dotfile.name, entry)
+    assert dotfile.state['code'] == 'missing'
+    assert probed == [str(dotfile.name)]
+
+    # the entry is stale once the dotfile has been changed
+    dotfile.enable()
+    del probed[:]
+    assert dotfile.state['code'] == 'link'
+    assert str(dotfile.target) in probed
+
+
+def test_known_dirs(repo, monkeypatch):
+    known_dirs = set()
+    dotfiles = [_make_dotfile(repo, x) for x in ['.cfg/a', '.cfg/b']]
+    for dotfile in dotfiles:
+        touch(dotfile.name)
+        dotfile.known_dirs = known_dirs
+
+    probed = []
+    is_dir = Path.is_dir
+
+    def counting(self):
+        probed.append(self)
+        return is_dir(self)
+    monkeypatch.setattr(Path, 'is_dir', counting)
+
+    for dotfile in dotfiles:
+        dotfile.add(home=repo.home)
+        assert is_link(dotfile.name)
+    assert probed.count(repo.home / '.cfg') == 1
+    assert probed.count(repo.path / '.cfg') == 1
 
 
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
@@ -68,12 +187,26 @@ def test_add(repo, path):
     assert is_file(dotfile.target)
     assert dotfile.name.samefile(dotfile.target)
 
-    with pytest.raises(IsSymlink):
-        dotfile.add()
+    with pytest.raises(InRepository):
+        dotfile.add(home=repo.home)
     assert is_file(dotfile.target)
     assert dotfile.name.samefile(dotfile.target)
 
 
+def test_add_after_prune(repo):
+    dotfile = _make_dotfile(repo, '.cfg/sub/rc')
+    touch(dotfile.name)
+
+    dotfile.add(home=repo.home)
+    dotfile.remove()
+    repo.prune()
+    assert not dotfile.target.parent.exists()
+
+    dotfile.add(home=repo.home)
+    assert is_link(dotfile.name)
+    assert is_file(dotfile.target)
+
+
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
 def test_remove(repo, path):
     dotfile = _make_dotfile(repo, path)
@@ -107,51 +240,70 @@ def test_remove(repo, path):
 
 
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
-def test_link(repo, path):
+def test_enable(repo, path):
     dotfile = _make_dotfile(repo, path)
 
     with pytest.raises(TargetMissing):
-        dotfile.link()
+        dotfile.enable()
 
     touch(dotfile.target)
-    dotfile.link()
+    dotfile.enable()
 
     assert is_file(dotfile.target)
     assert is_link(dotfile.name)
     assert dotfile.name.samefile(dotfile.target)
 
     with pytest.raises(Exists):
-        dotfile.link()
+        dotfile.enable()
 
     assert is_file(dotfile.target)
     assert is_link(dotfile.name)
     assert dotfile.name.samefile(dotfile.target)
 
 
+@pytest.mark.parametrize('name, target', [
+    ('.foo', 'repo/foo'),
+    ('.foo/bar/baz', 'repo/baz'),
+    ('.foo', 'repo/foo/bar/baz'),
+    ('.foo/bar', 'repo/.foo/bar'),
+    ('.foo', 'foo'),                # same directory
+    ('.foo/bar', '.foo/baz'),       # same directory
+])
+def test_enable_relative(repo, monkeypatch, name, target):
+    monkeypatch.setattr(Dotfile, 'RELATIVE_SYMLINKS', True)
+    dotfile = Dotfile(repo.home / name, repo.home / target)
+    touch(dotfile.target)
+    dotfile.enable()
+
+    link = os.readlink(str(dotfile.name))
+    assert link == os.path.relpath(str(dotfile.target),
+                                   str(dotfile.name.parent))
+    assert not os.path.isabs(link)
+    assert dotfile.name.samefile(dotfile.target)
+
+
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
-def test_unlink(repo, path):
+def test_disable(repo, path):
     dotfile = _make_dotfile(repo, path)
 
     with pytest.raises(NotASymlink):
-        dotfile.unlink()
+        dotfile.disable()
 
-    # py.path.local(dotfile.name.dirname).ensure_dir()
-    # dotfile.name.mksymlinkto(dotfile.target)
+    # a dangling symlink is removed as well
     mkdir(dotfile.name.parent)
     dotfile.name.symlink_to(dotfile.target)
+    dotfile.disable()
+    assert not os.path.lexists(str(dotfile.name))
 
-    with pytest.raises(TargetMissing):
-        dotfile.unlink()
-
-    # dotfile.target.ensure()
     touch(dotfile.target)
-    dotfile.unlink()
+    dotfile.name.symlink_to(dotfile.target)
+    dotfile.disable()
 
     assert is_file(dotfile.target)
     assert not dotfile.name.exists()
 
     with pytest.raises(NotASymlink):
-        dotfile.unlink()
+        dotfile.disable()
 
     assert is_file(dotfile.target)
     assert not dotfile.name.exists()
@@ -159,6 +311,54 @@ def test_unlink(repo, path):
 
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
 def test_copy(repo, path):
-    pass
-    # dotfile = _make_dotfile(repo, path)
-    # TODO
+    dotfile = _make_dotfile(repo, path)
+    touch(dotfile.name)
+    dotfile.name.write_text('content')
+
+    dotfile.add(copy=True)
+    assert is_file(dotfile.name)
+    assert is_file(dotfile.target)
+    assert dotfile.target.read_text() == 'content'
+    assert dotfile.state['code'] == 'copy'
+
+
+def test_copyfile(tmpdir):
+    source = Path(str(tmpdir), 'source')
+    target = Path(str(tmpdir), 'target')
+    data = os.urandom(3 * BUFSIZE + 1)
+    source.write_bytes(data)
+    target.write_bytes(bytes(5 * BUFSIZE))
+
+    _copyfile(source, target)
+    assert target.read_bytes() == data
+
+    with pytest.raises(SameFileError):
+        _copyfile(source, source)
+    assert source.read_bytes() == data
+
+
+def test_copyfile_fallback(tmpdir, monkeypatch):
+    source = Path(str(tmpdir), 'source')
+    target = Path(str(tmpdir), 'target')
+    data = os.urandom(3 * BUFSIZE + 1)
+    source.write_bytes(data)
+
+    if hasattr(os, 'copy_file_range'):
+        # copy a first chunk, then refuse like a cross-device copy
+        copy_file_range = os.copy_file_range
+        calls = []
+
+        def refuse(src, dst, count):
+            calls.append(count)
+            if len(calls) > 1:
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return copy_file_range(src, dst, BUFSIZE)
+        monkeypatch.setattr(os, 'copy_file_range', refuse)
+        _copyfile(source, target)
+        assert len(calls) == 2
+        assert target.read_bytes() == data
+        target.unlink()
+
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    _copyfile(source, target)
+    assert target.read_bytes() == data
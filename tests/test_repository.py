@@ -1,17 +1,22 @@
+import json
+import os
 import pytest
+import time
 
 from pathlib import Path
-from dotfiles.exceptions import NotRootedInHome, TargetIgnored, \
+from dotman.exceptions import NotRootedInHome, TargetIgnored, \
     IsDirectory, InRepository
-from dotfiles.repository import Repository, \
-    REMOVE_LEADING_DOT, IGNORE_PATTERNS
+from dotman.repository import Repository
+
+REMOVE_LEADING_DOT = Repository.REMOVE_LEADING_DOT
+IGNORE_PATTERNS = Repository.IGNORE_PATTERNS
 
 
 def test_repo_create(repo):
     repo.path.rmdir()
     assert not repo.path.exists()
 
-    Repository(repo.path, repo.homedir)
+    Repository(repo.path, repo.home)
     assert repo.path.exists()
     assert repo.path.is_dir()
 
@@ -20,15 +25,14 @@ def test_repo_create(repo):
 @pytest.mark.parametrize('ignore', [IGNORE_PATTERNS, ['foo', 'bar', 'baz']])
 def test_params(repo, dot, ignore):
 
-    _repo = Repository(repo.path,
-                       homedir=repo.homedir,
-                       remove_leading_dot=dot,
-                       ignore_patterns=ignore)
+    _repo = Repository(repo.path, repo.home)
+    _repo.REMOVE_LEADING_DOT = dot
+    _repo.IGNORE_PATTERNS = ignore
 
     assert _repo.path == repo.path
-    assert _repo.homedir == repo.homedir
-    assert _repo.remove_leading_dot == dot
-    assert _repo.ignore_patterns == ignore
+    assert _repo.home == repo.home
+    assert _repo.REMOVE_LEADING_DOT == dot
+    assert _repo.IGNORE_PATTERNS == ignore
 
 
 def test_contents(repo):
@@ -59,32 +63,32 @@ def test_str(repo):
     Path(repo.path / 'c').touch()
 
     assert str(repo) == (
-        '%s\n%s\n%s' % (repo.homedir / '.a',
-                        repo.homedir / '.b',
-                        repo.homedir / '.c'))
+        '%s\n%s\n%s' % (repo.home / 'a',
+                        repo.home / 'b',
+                        repo.home / 'c'))
 
 
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
 def test_dotfile_path(repo, path):
 
-    repo.remove_leading_dot = False
+    repo.REMOVE_LEADING_DOT = False
     assert (repo._dotfile_path(repo.path / path) ==
-            repo.homedir / path)
+            repo.home / path)
 
-    repo.remove_leading_dot = True
+    repo.REMOVE_LEADING_DOT = True
     assert (repo._dotfile_path(repo.path / path) ==
-            repo.homedir / ('.%s' % path))
+            repo.home / ('.%s' % path))
 
 
 @pytest.mark.parametrize('path', ['.foo', '.foo/bar/baz'])
 def test_dotfile_target(repo, path):
 
-    repo.remove_leading_dot = False
-    assert (repo._dotfile_target(repo.homedir / path) ==
+    repo.REMOVE_LEADING_DOT = False
+    assert (repo._dotfile_target(repo.home / path) ==
             repo.path / path)
 
-    repo.remove_leading_dot = True
-    assert (repo._dotfile_target(repo.homedir / path) ==
+    repo.REMOVE_LEADING_DOT = True
+    assert (repo._dotfile_target(repo.home / path) ==
             repo.path / path[1:])
 
 
@@ -94,35 +98,35 @@ def test_dotfile(repo):
         repo._dotfile(Path('/tmp/foo'))
 
     with pytest.raises(TargetIgnored):
-        repo.ignore_patterns = ['.foo']
-        repo.remove_leading_dot = False
-        repo._dotfile(repo.homedir / '.foo')
+        repo.IGNORE_PATTERNS = ['.foo']
+        repo.REMOVE_LEADING_DOT = False
+        repo._dotfile(repo.home / '.foo')
 
     with pytest.raises(TargetIgnored):
-        repo.ignore_patterns = ['foo']
-        repo._dotfile(repo.homedir / '.bar/foo')
+        repo.IGNORE_PATTERNS = ['foo']
+        repo._dotfile(repo.home / '.bar/foo')
 
     with pytest.raises(IsDirectory):
-        dir = repo.homedir / '.config'
+        dir = repo.home / '.config'
         dir.mkdir()
         repo._dotfile(dir)
 
     # The repo fixture is parametrized, we can only expect InRepository
     # exception when the repository is contained in the home directory.
-    if repo.path.parent == repo.homedir.name:
+    if repo.path.parent == repo.home.name:
         with pytest.raises(InRepository):
             repo._dotfile(repo.path / '.foo/bar')
 
 
 def test_dotfiles(repo):
 
-    subdir_a = repo.homedir / '.dir'
-    subdir_b = repo.homedir / '.dir/foo'
+    subdir_a = repo.home / '.dir'
+    subdir_b = repo.home / '.dir/foo'
 
     for subdir in [subdir_a, subdir_b]:
         subdir.mkdir()
 
-    file_a = repo.homedir / '.baz'
+    file_a = repo.home / '.baz'
     file_b = subdir_a / 'bar'
     file_c = subdir_a / 'boo'
     file_d = subdir_b / 'bat'
@@ -159,3 +163,82 @@ def test_prune(repo):
     contents = [x for x in repo.path.rglob('*')]
     assert str(dir_d) in map(str, contents)
     assert len(contents) == 1
+
+
+def _names(repo):
+    return [str(x.target.relative_to(repo.path)) for x in repo.contents()]
+
+
+def _backdate(repo, seconds=10):
+    # directories this old are no longer racy, see RACY_NS
+    ns = int((time.time() - seconds) * 10 ** 9)
+    for dir, _, _ in os.walk(str(repo.path)):
+        os.utime(dir, ns=(ns, ns))
+
+
+def test_index(repo, index, monkeypatch):
+    (repo.path / 'a/b').mkdir(parents=True)
+    (repo.path / 'x').touch()
+    (repo.path / 'a/b/y').touch()
+    _backdate(repo)
+    assert _names(repo) == ['a/b/y', 'x']
+    assert str(repo.path) in json.loads(index.read_text())
+
+    # served from the index without listing any directory
+    with monkeypatch.context() as m:
+        m.setattr(os, 'scandir', None)
+        assert _names(repo) == ['a/b/y', 'x']
+
+    (repo.path / 'a/b/z').touch()
+    assert _names(repo) == ['a/b/y', 'a/b/z', 'x']
+
+    (repo.path / 'a/b/y').unlink()
+    assert _names(repo) == ['a/b/z', 'x']
+
+
+def test_index_racy(repo, index):
+    (repo.path / 'x').touch()
+    assert _names(repo) == ['x']
+
+    # a change within the timestamp granularity keeps the directory time
+    mtime = os.stat(str(repo.path)).st_mtime_ns
+    (repo.path / 'y').touch()
+    os.utime(str(repo.path), ns=(mtime, mtime))
+    assert _names(repo) == ['x', 'y']
+
+
+def test_index_skips_git(repo, index, monkeypatch):
+    (repo.path / '.git/objects/ab').mkdir(parents=True)
+    (repo.path / '.git/objects/ab/cdef').touch()
+    (repo.path / 'x').touch()
+    _backdate(repo)
+    assert _names(repo) == ['x']
+
+    dirs = json.loads(index.read_text())[str(repo.path)]['dirs']
+    assert list(dirs) == [str(repo.path)]
+
+    # committing to the repository does not invalidate the index
+    (repo.path / '.git/objects/ab/0123').touch()
+    (repo.path / '.git/COMMIT_EDITMSG').touch()
+    with monkeypatch.context() as m:
+        m.setattr(os, 'scandir', None)
+        assert _names(repo) == ['x']
+
+
+def test_index_drops_missing(repo, index, tmpdir):
+    other = Repository(str(tmpdir.ensure_dir('other')), repo.home, index)
+    other.contents()
+    repo.contents()
+    assert str(other.path) in json.loads(index.read_text())
+
+    other.path.rmdir()
+    (repo.path / 'x').touch()
+    repo.contents()
+    assert list(json.loads(index.read_text())) == [str(repo.path)]
+
+
+def test_index_disabled(repo, index):
+    repo = Repository(repo.path, repo.home)
+    (repo.path / 'x').touch()
+    assert _names(repo) == ['x']
+    assert not index.exists()